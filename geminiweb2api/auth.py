@@ -1,13 +1,29 @@
 import requests
 import re
 import json
+from http.cookiejar import DefaultCookiePolicy
 from urllib.parse import urlparse
 from typing import Dict, Tuple, Optional
+from requests.adapters import HTTPAdapter
 from .constants import Endpoints, Headers
 
+# Matched against raw bytes so the (large) init page never needs a full decode
+_SNLM0E_RE = re.compile(rb'"SNlM0e":"([^"]+)"')
+
 class AuthError(Exception):
     pass
 
+class DiscardCookiesPolicy(DefaultCookiePolicy):
+    """Never store response cookies, so accounts sharing a session don't mix jars."""
+    def set_ok(self, cookie, request):
+        return False
+
+# Shared pooled session: keeps TLS connections to google.com / gemini.google.com /
+# accounts.google.com alive across init and rotation calls. Cookies are passed per call.
+_SESSION = requests.Session()
+_SESSION.cookies.set_policy(DiscardCookiesPolicy())
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50))
+
 def get_access_token(cookies: Dict[str, str], proxy: Optional[str] = None) -> Tuple[str, Dict[str, str]]:
     """
     Retrieves the SNlM0e nonce (access token) and verifies cookies.
@@ -17,7 +33,7 @@ def get_access_token(cookies: Dict[str, str], proxy: Optional[str] = None) -> Tu
     
     # 1. Prime Google cookies (optional but good practice)
     try:
-        requests.get(Endpoints.Google, proxies=proxies, timeout=10)
+        _SESSION.get(Endpoints.Google, proxies=proxies, timeout=10)
     except Exception:
         pass
 
@@ -29,30 +45,30 @@ def get_access_token(cookies: Dict[str, str], proxy: Optional[str] = None) -> Tu
          pass
 
     # 3. Send Init Request to get SNlM0e
-    session = requests.Session()
-    session.headers.update(Headers.Gemini)
-    session.proxies.update(proxies or {})
-    
-    # Apply cookies
-    for k, v in cookies.items():
-        session.cookies.set(k, v)
-
     try:
-        resp = session.get(Endpoints.Init, timeout=20)
+        resp = _SESSION.get(
+            Endpoints.Init,
+            headers=Headers.Gemini,
+            cookies=cookies,
+            proxies=proxies,
+            timeout=20
+        )
         resp.raise_for_status()
     except Exception as e:
         raise AuthError(f"Init request failed: {e}")
 
     # Extract Token
-    match = re.search(r'"SNlM0e":"([^"]+)"', resp.text)
+    match = _SNLM0E_RE.search(resp.content)
     if not match:
         raise AuthError("Failed to retrieve SNlM0e token from response.")
     
-    token = match.group(1)
+    token = match.group(1).decode("utf-8")
     
-    # Update cookies with any new ones from response
+    # Update cookies with any new ones from response (including redirects)
     valid_cookies = cookies.copy()
-    valid_cookies.update(session.cookies.get_dict())
+    for r in resp.history:
+        valid_cookies.update(r.cookies.get_dict())
+    valid_cookies.update(resp.cookies.get_dict())
     
     return token, valid_cookies
 
@@ -71,7 +87,7 @@ def rotate_1psidts(cookies: Dict[str, str], proxy: Optional[str] = None) -> Opti
     body = '[000,"-0000000000000000000"]'
     
     try:
-        resp = requests.post(
+        resp = _SESSION.post(
             Endpoints.RotateCookies,
             data=body,  # Use data= not json= for raw body
             headers=Headers.RotateCookies,
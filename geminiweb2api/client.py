@@ -1,16 +1,46 @@
 import requests
-import json
+import orjson
 import time
 import random
 import string
 import re
 import os
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import List, Optional, Dict, Any, Union, Callable
 from .constants import Endpoints, Headers, ErrorCode
 from .models import ModelOutput, Candidate, WebImage, GeneratedImage, Image
-from .auth import get_access_token, rotate_1psidts, AuthError
+from .auth import get_access_token, rotate_1psidts, AuthError, DiscardCookiesPolicy
 from .conversation import ChatSession
 
+# Caps on concurrent outstanding requests per upstream host, shared by all clients
+MAX_CONCURRENT_GENERATES = 16
+MAX_CONCURRENT_UPLOADS = 32
+_GENERATE_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_GENERATES)
+_UPLOAD_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
+
+_IMG_PLACEHOLDER_RE = re.compile(r'http://googleusercontent\.com/image_generation_content/\d+')
+
+GENERATE_MAX_ATTEMPTS = 3
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_PARALLEL_UPLOADS = 8
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# gem_id sits at index 19 of the inner request list: 16 nulls follow [item0, null, item2]
+_NULLS16 = ',null' * 16
+
+def _get_nested(obj: Any, path: tuple, default: Any = None) -> Any:
+    """Walk nested lists by index, returning default if any level is missing or not a list."""
+    for key in path:
+        # Strings are indexable too; only descend into lists
+        if not isinstance(obj, list) or key >= len(obj):
+            return default
+        obj = obj[key]
+    return obj
+
 class GeminiClient:
     def __init__(self, secure_1psid: str, secure_1psidts: Optional[str] = None, proxy: Optional[str] = None, on_cookies_updated: Optional[Callable[[Dict[str, str]], None]] = None, full_cookies: Optional[Dict[str, str]] = None):
         # If full_cookies provided, use it as base (for image operations that need more cookies)
@@ -28,12 +58,25 @@ class GeminiClient:
         
         self.proxy = proxy
         self.session = requests.Session()
+        # Keep up to 64 pooled Gemini connections; retry connection failures and idempotent 5xx
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=64,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False)
+        ))
         self.access_token = None
         self.running = False
+        self._init_lock = threading.Lock()
         self.on_cookies_updated = on_cookies_updated
         
+        # Separate pooled session for content-push uploads; never carries account cookies
+        self.upload_session = requests.Session()
+        self.upload_session.cookies.set_policy(DiscardCookiesPolicy())
+        self.upload_session.mount("https://content-push.googleapis.com", HTTPAdapter(pool_maxsize=20))
+        
         if proxy:
             self.session.proxies.update({"http": proxy, "https": proxy})
+            self.upload_session.proxies.update({"http": proxy, "https": proxy})
 
     def refresh_cookies(self) -> bool:
         """
@@ -73,34 +116,40 @@ class GeminiClient:
             raise AuthError(f"Initialization failed: {e}")
 
     def _ensure_running(self):
+        # Pooled clients are shared by concurrent requests; only one of them fetches the token
         if not self.running:
-            self.init()
+            with self._init_lock:
+                if not self.running:
+                    self.init()
 
-    def _upload_file(self, path: str) -> str:
+    def _upload_file(self, path: str, filename: Optional[str] = None) -> str:
         """Uploads a file to Gemini's content-push service and returns the ID."""
-        if not os.path.exists(path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
             raise Exception(f"File not found: {path}")
 
-        filename = os.path.basename(path)
+        if filename is None:
+            filename = os.path.basename(path)
         # Headers specifically for upload
         # Do NOT use Headers.Gemini as base because it has Host: gemini.google.com
         headers = Headers.Upload.copy()
         headers["User-Agent"] = Headers.Gemini["User-Agent"]
         
-        with open(path, 'rb') as f:
+        with f:
             files = {
                 'file': (filename, f, 'application/octet-stream')
             }
             try:
-                # Use bare requests to avoid sending session cookies (matches Go implementation)
-                proxies = self.session.proxies if self.proxy else None
-                resp = requests.post(
-                    Endpoints.Upload,
-                    files=files,
-                    headers=headers,
-                    timeout=300,
-                    proxies=proxies
-                )
+                # Use the cookie-less upload session (matches Go implementation)
+                with _UPLOAD_SLOTS:
+                    resp = self.upload_session.post(
+                        Endpoints.Upload,
+                        files=files,
+                        headers=headers,
+                        timeout=300,
+                        cookies={}
+                    )
                 if resp.status_code != 200:
                      raise Exception(f"Status {resp.status_code}: {resp.text}")
                 return resp.text.strip()
@@ -110,11 +159,16 @@ class GeminiClient:
     def generate_content(self, prompt: str, files: List[str], model: str, gem_id: Optional[str], chat: Optional[ChatSession] = None) -> ModelOutput:
         self._ensure_running()
         
-        # Upload files
+        # Upload files concurrently (still bounded globally by _UPLOAD_SLOTS)
+        fnames = [os.path.basename(f) for f in files]
+        if len(files) > 1:
+            with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_UPLOADS, len(files))) as executor:
+                fids = list(executor.map(self._upload_file, files, fnames))
+        else:
+            fids = [self._upload_file(f, fname) for f, fname in zip(files, fnames)]
+        
         uploaded_files = [] 
-        for f in files:
-            fid = self._upload_file(f)
-            fname = os.path.basename(f)
+        for fid, fname in zip(fids, fnames):
             # Structure matches Go: [[id], filename]
             uploaded_files.append([[fid], fname])
 
@@ -128,61 +182,74 @@ class GeminiClient:
         item2 = chat.metadata if chat else None
         
         # Structure: [item0, nil, item2, ..., gem_id, ..., 14 (if nano)]
-        inner = [item0, None, item2]
+        # Spliced as strings so only the variable parts go through the serializer
+        inner_json = '[' + orjson.dumps(item0).decode() + ',null,' + orjson.dumps(item2).decode()
         
         if gem_id:
-            # Pad to index 19 (16 nils + current length 3?) -> Go code pads 16 nils AFTER inner items?
             # Go: inner = []any{item0, nil, item2} (len 3)
             # append 16 nils -> len 19
             # append gemID -> len 20 (index 19)
-            inner.extend([None] * 16)
-            inner.append(gem_id)
-            
-        inner_json = json.dumps(inner)
-        outer = [None, inner_json]
-        outer_json = json.dumps(outer)
+            inner_json += _NULLS16 + ',' + orjson.dumps(gem_id).decode()
+        inner_json += ']'
+        
+        # Outer: [nil, inner_json]
+        outer_json = '[null,' + orjson.dumps(inner_json).decode() + ']'
         
         params = {
             "at": self.access_token,
             "f.req": outer_json
         }
         
-        headers = Headers.Gemini.copy()
-        # Add model specific headers if needed (simplified here)
-        
-        try:
-            resp = self.session.post(
-                Endpoints.Generate, 
-                data=params, 
-                headers=headers, 
-                timeout=120
-            )
-            resp.raise_for_status()
-        except requests.HTTPError as e:
-            if e.response.status_code == 429:
-                raise Exception("Too many requests (429)")
-            raise e
-
-        return self._parse_response(resp.text)
+        # Retry rate limits and server errors with exponential backoff (sleep outside the slot).
+        # The body is streamed, so the slot is held until it has been read and parsed.
+        for attempt in range(GENERATE_MAX_ATTEMPTS):
+            with _GENERATE_SLOTS:
+                resp = self.session.post(
+                    Endpoints.Generate, 
+                    data=params, 
+                    headers=Headers.Gemini,
+                    timeout=120,
+                    stream=True
+                )
+                if resp.status_code not in RETRY_STATUS_CODES or attempt == GENERATE_MAX_ATTEMPTS - 1:
+                    try:
+                        resp.raise_for_status()
+                    except requests.HTTPError as e:
+                        resp.close()
+                        if e.response.status_code == 429:
+                            raise Exception("Too many requests (429)")
+                        raise e
+                    return self._parse_response(resp)
+            resp.close()
+            time.sleep(2 ** attempt + random.random())
 
-    def _parse_response(self, text: str) -> ModelOutput:
-        lines = text.splitlines()
-        if len(lines) < 3:
-             raise Exception("Invalid response format (too short)")
-        
-        # The data is usually on line 3 (index 2)
-        try:
-            data = json.loads(lines[2])
-        except json.JSONDecodeError:
-             # Fallback scan
-             data = None
-             for line in lines[3:]:
-                 try:
-                     t = json.loads(line)
-                     if isinstance(t, list) and len(t) > 0:
-                         data = t
-                         break
-                 except: continue
+    def _parse_response(self, resp: requests.Response) -> ModelOutput:
+        # Read the streamed body line by line and parse only up to the data line
+        with resp:
+            # Raw bytes: orjson parses them directly without a separate decode. A large
+            # chunk size keeps multi-MB lines from being reassembled 512 bytes at a time.
+            lines = resp.iter_lines(chunk_size=STREAM_CHUNK_SIZE)
+            head = list(itertools.islice(lines, 3))
+            if len(head) < 3:
+                 raise Exception("Invalid response format (too short)")
+            
+            # The data is usually on line 3 (index 2)
+            try:
+                data = orjson.loads(head[2])
+            except orjson.JSONDecodeError:
+                 # Fallback scan
+                 data = None
+                 for line in lines:
+                     try:
+                         t = orjson.loads(line)
+                         if isinstance(t, list) and len(t) > 0:
+                             data = t
+                             break
+                     except: continue
+            
+            # Read (without parsing) the rest of the body so the connection returns to the pool
+            for _ in lines:
+                pass
         
         if not data:
             raise Exception("No valid JSON data found in response")
@@ -198,7 +265,7 @@ class GeminiClient:
         for item in response_json:
             if isinstance(item, list) and len(item) > 2 and isinstance(item[2], str):
                 try:
-                    inner = json.loads(item[2])
+                    inner = orjson.loads(item[2])
                     if isinstance(inner, list) and len(inner) > 4 and inner[4] is not None:
                          main_part = inner
                          break
@@ -224,9 +291,7 @@ class GeminiClient:
                 if not isinstance(cand_raw, list): continue
                 
                 # Text: cand_raw[1][0]
-                text = ""
-                if len(cand_raw) > 1 and isinstance(cand_raw[1], list) and len(cand_raw[1]) > 0:
-                    text = cand_raw[1][0]
+                text = _get_nested(cand_raw, (1, 0), "")
                 
                 generated_images = []
                 # Check for generated image placeholder
@@ -237,51 +302,36 @@ class GeminiClient:
                         # item must be list, len>2, item[2] is str
                         if isinstance(item, list) and len(item) > 2 and isinstance(item[2], str):
                              try:
-                                 mp = json.loads(item[2])
-                                 # Looking for structure [4][i][12][7][0]
-                                 if isinstance(mp, list) and len(mp) > 4:
-                                     tt = mp[4]
-                                     if isinstance(tt, list) and len(tt) > i:
-                                         sec = tt[i]
-                                         if isinstance(sec, list) and len(sec) > 12:
-                                             ss = sec[12]
-                                             if isinstance(ss, list) and len(ss) > 7:
-                                                 first = ss[7]
-                                                 if isinstance(first, list) and len(first) > 0 and first[0] is not None:
-                                                     img_body = mp
-                                                     break
+                                 mp = orjson.loads(item[2])
                              except: continue
+                             # Looking for structure [4][i][12][7][0]
+                             if isinstance(mp, list) and _get_nested(mp, (4, i, 12, 7, 0)) is not None:
+                                 img_body = mp
+                                 break
                     
                     if img_body:
                          # Parse images from img_body
                          img_cand = img_body[4][i] # list
                          # Text update (remove placeholder)
-                         if len(img_cand) > 1 and isinstance(img_cand[1], list) and len(img_cand[1]) > 0:
-                             raw_text = img_cand[1][0]
-                             text = re.sub(r'http://googleusercontent\.com/image_generation_content/\d+', '', raw_text).strip()
+                         raw_text = _get_nested(img_cand, (1, 0))
+                         if isinstance(raw_text, str):
+                             text = _IMG_PLACEHOLDER_RE.sub('', raw_text).strip()
                          
                          # Images at [12][7][0]
-                         if len(img_cand) > 12 and isinstance(img_cand[12], list) and len(img_cand[12]) > 7:
-                             s2 = img_cand[12][7]
-                             if isinstance(s2, list) and len(s2) > 0:
-                                 s3 = s2[0]
-                                 if isinstance(s3, list):
-                                     for gi in s3:
-                                         if not isinstance(gi, list) or len(gi) < 4: continue
-                                         # URL: gi[0][3][3]
-                                         url = ""
-                                         if isinstance(gi[0], list) and len(gi[0]) > 3:
-                                             b1 = gi[0][3]
-                                             if isinstance(b1, list) and len(b1) > 3:
-                                                 url = b1[3]
-                                         
-                                         title = "[Generated Image]"
-                                         alt = ""
-                                         
-                                         generated_images.append(GeneratedImage(
-                                             image=Image(url=url, title=title, alt=alt),
-                                             cookies=self.cookies
-                                         ))
+                         s3 = _get_nested(img_cand, (12, 7, 0))
+                         if isinstance(s3, list):
+                             for gi in s3:
+                                 if not isinstance(gi, list) or len(gi) < 4: continue
+                                 # URL: gi[0][3][3]
+                                 url = _get_nested(gi, (0, 3, 3), "")
+                                 
+                                 title = "[Generated Image]"
+                                 alt = ""
+                                 
+                                 generated_images.append(GeneratedImage(
+                                     image=Image(url=url, title=title, alt=alt),
+                                     cookies=self.cookies
+                                 ))
                 
                 # Check for card content replacement (rcid logic from Go)
                 # ... simplified for now
@@ -1,33 +1,41 @@
+from dataclasses import dataclass, field
 from typing import List, Optional, Dict
-from pydantic import BaseModel
 
-class Image(BaseModel):
+# Plain slotted dataclasses: these are built from our own parser output on every
+# response, so they skip validation entirely.
+
+@dataclass(slots=True)
+class Image:
     url: str
     title: Optional[str] = None
     alt: Optional[str] = None
 
-class WebImage(BaseModel):
+@dataclass(slots=True)
+class WebImage:
     image: Image
 
-class GeneratedImage(BaseModel):
+@dataclass(slots=True)
+class GeneratedImage:
     image: Image
     cookies: Optional[Dict[str, str]] = None
 
-class Candidate(BaseModel):
+@dataclass(slots=True)
+class Candidate:
     rcid: str
     text: str
     thoughts: Optional[str] = None
-    web_images: List[WebImage] = []
-    generated_images: List[GeneratedImage] = []
+    web_images: List[WebImage] = field(default_factory=list)
+    generated_images: List[GeneratedImage] = field(default_factory=list)
 
     def visuals(self) -> List[Image]:
         imgs = [w.image for w in self.web_images]
         imgs.extend([g.image for g in self.generated_images])
         return imgs
 
-class ModelOutput(BaseModel):
-    metadata: List[str] = []
-    candidates: List[Candidate] = []
+@dataclass(slots=True)
+class ModelOutput:
+    metadata: List[str] = field(default_factory=list)
+    candidates: List[Candidate] = field(default_factory=list)
     chosen: int = 0
 
     @property
@@ -35,7 +43,7 @@ class ModelOutput(BaseModel):
         if not self.candidates:
             return ""
         return self.candidates[self.chosen].text
-    
+
     @property
     def rcid(self) -> str:
         if not self.candidates:
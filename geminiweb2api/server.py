@@ -9,15 +9,30 @@ import time
 import uuid
 import os
 import asyncio
-import json
+import orjson
 import base64
 import hashlib
 import secrets
+import hmac
 import requests
+from requests.adapters import HTTPAdapter
 import random
+import re
+import threading
+import functools
+from collections import defaultdict
+import heapq
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-from .client import GeminiClient
+from .client import GeminiClient, MAX_CONCURRENT_GENERATES, MAX_CONCURRENT_UPLOADS
 from .conversation import ChatSession
+from .auth import DiscardCookiesPolicy
+from .constants import Headers
 
 app = FastAPI(title="GeminiWeb2API", version="0.2.0")
 
@@ -48,6 +63,10 @@ DATA_DIR = os.environ.get("DATA_DIR", ".")
 os.makedirs(DATA_DIR, exist_ok=True)
 DATA_FILE = os.path.join(DATA_DIR, "cookies.json")
 COOKIE_REFRESH_INTERVAL = 1800  # 30 minutes
+COOKIE_REFRESH_CONCURRENCY = 8  # parallel RotateCookies calls per refresh cycle
+DATA_FLUSH_INTERVAL = 2  # seconds
+USAGE_FLUSH_INTERVAL = 10  # seconds between merging pending use counts into the data
+CLIENT_POOL_TTL = 1800  # seconds before a pooled client is rebuilt (re-fetches its access token)
 
 # =============================================================================
 # Data Models
@@ -75,14 +94,22 @@ class SettingsUpdate(BaseModel):
 # Data Storage
 # =============================================================================
 
-def load_data() -> Dict:
+# In-memory copy of DATA_FILE. Mutations go through save_data(), which only marks it
+# dirty; data_flush_loop() writes it back at most once per DATA_FLUSH_INTERVAL.
+_data_cache: Optional[Dict] = None
+_data_dirty = False
+_data_mtime = 0  # st_mtime_ns of DATA_FILE as last read or written by us
+_data_lock = threading.RLock()
+_flush_lock = threading.Lock()
+
+def _read_data_file() -> Dict:
     """Load data from JSON file, migrating old format if needed"""
     default = {"cookies": {}, "settings": {"admin_username": "admin", "admin_password": "admin", "api_key": "sk-123456", "image_mode": "url", "base_url": "", "plugin_token": ""}}
     
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
+            with open(DATA_FILE, 'rb') as f:
+                data = orjson.loads(f.read())
             
             # Check if old format (has "psid" at root level)
             if "psid" in data and "cookies" not in data:
@@ -105,8 +132,7 @@ def load_data() -> Dict:
                 
                 # Migrate existing cookie if valid
                 if old_psid:
-                    import hashlib
-                    cookie_id = hashlib.md5(old_psid.encode()).hexdigest()[:16]
+                    cookie_id = make_cookie_id(old_psid)
                     new_data["cookies"][cookie_id] = {
                         "psid": old_psid,
                         "psidts": old_psidts,
@@ -128,7 +154,7 @@ def load_data() -> Dict:
             
             # Ensure plugin_token exists
             if "plugin_token" not in data["settings"] or not data["settings"]["plugin_token"]:
-                data["settings"]["plugin_token"] = secrets.token_urlsafe(32)
+                data["settings"]["plugin_token"] = generate_token()
                 save_data(data)
             
             return data
@@ -136,13 +162,86 @@ def load_data() -> Dict:
             print(f"Error loading data: {e}")
     
     # Generate token for new install
-    default["settings"]["plugin_token"] = secrets.token_urlsafe(32)
+    default["settings"]["plugin_token"] = generate_token()
     return default
 
+def _data_file_mtime() -> int:
+    try:
+        return os.stat(DATA_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def load_data() -> Dict:
+    """Return the shared in-memory data, reading the file on first use"""
+    global _data_cache, _data_mtime
+    # Fast path for the per-request readers (get_settings, get_cookies): no lock once loaded
+    data = _data_cache
+    if data is not None:
+        return data
+    with _data_lock:
+        if _data_cache is None:
+            _data_mtime = _data_file_mtime()
+            _data_cache = _read_data_file()
+            _index_active_cookies()
+        return _data_cache
+
 def save_data(data: Dict):
-    """Save data to JSON file"""
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Replace the in-memory data and schedule it for writing to disk"""
+    global _data_cache, _data_dirty
+    with _data_lock:
+        _data_cache = data
+        _data_dirty = True
+
+def flush_data():
+    """Atomically write data to disk if it changed since the last flush"""
+    global _data_dirty, _data_mtime
+    with _flush_lock:
+        with _data_lock:
+            if not _data_dirty or _data_cache is None:
+                return
+            payload = orjson.dumps(_data_cache, option=orjson.OPT_INDENT_2)
+            _data_dirty = False
+        # Unique temp file per write: with several workers a shared name would let one
+        # truncate the file another is about to move into place
+        fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".cookies.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, DATA_FILE)
+            _data_mtime = _data_file_mtime()
+        except Exception:
+            with _data_lock:
+                _data_dirty = True
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+def reload_data_if_changed():
+    """Pick up external edits to DATA_FILE, unless there are unsaved in-memory changes"""
+    global _data_cache, _data_mtime
+    with _flush_lock:
+        mtime = _data_file_mtime()
+        if not mtime or mtime == _data_mtime:
+            return
+        with _data_lock:
+            if _data_dirty or _data_cache is None:
+                return
+            # Don't replace good state with defaults if the edited file is broken
+            try:
+                with open(DATA_FILE, 'rb') as f:
+                    orjson.loads(f.read())
+            except Exception as e:
+                print(f"Ignoring unreadable {DATA_FILE}: {e}")
+                _data_mtime = mtime
+                return
+            print("Data file changed on disk, reloading...")
+            _data_mtime = mtime
+            _data_cache = _read_data_file()
+            _index_active_cookies()
 
 def get_settings() -> Dict:
     return load_data().get("settings", {})
@@ -150,24 +249,89 @@ def get_settings() -> Dict:
 def get_cookies() -> Dict:
     return load_data().get("cookies", {})
 
+# IDs of cookies with status 正常, the PSID -> ID map, and the /api/stats counters. Rebuilt
+# (under _data_lock) whenever a cookie is added, removed or changes status, so request-time
+# selection, PSID lookups and stats need no scan over all cookies. The map also covers
+# entries keyed by the older md5 IDs or by hand. "unused" is also kept current by
+# increment_cookie_usage.
+_active_cookie_ids: List[str] = []
+_cookie_ids_by_psid: Dict[str, str] = {}
+_cookie_stats = {"total": 0, "active": 0, "failed": 0, "unused": 0}
+
+# Use counts not yet merged into the data (see merge_pending_usage), so a successful
+# chat request doesn't dirty the whole store by itself
+_pending_usage: Dict[str, int] = defaultdict(int)
+
+def _index_active_cookies():
+    global _active_cookie_ids, _cookie_ids_by_psid, _cookie_stats
+    cookies = get_cookies()
+    active, failed, unused = [], 0, 0
+    by_psid = {}
+    for cid, c in cookies.items():
+        by_psid.setdefault(c.get("psid"), cid)
+        cookie_status = c.get("status")
+        if cookie_status == "正常":
+            active.append(cid)
+        elif cookie_status == "失效":
+            failed += 1
+        if c.get("use_count", 0) == 0 and cid not in _pending_usage:
+            unused += 1
+    _active_cookie_ids = active
+    _cookie_ids_by_psid = by_psid
+    _cookie_stats = {"total": len(cookies), "active": len(active), "failed": failed, "unused": unused}
+
 # =============================================================================
 # Authentication
 # =============================================================================
 
 # Simple token store (in production, use proper sessions/JWT)
 admin_tokens: Dict[str, float] = {}  # token -> expiry timestamp
+ADMIN_TOKEN_TTL = 3600  # 1 hour, extended on each use
+
+# (expiry, token) min-heap for cheap expiry sweeps. Entries go stale when a token is
+# extended; they're re-pushed with the real expiry when they reach the top.
+_admin_token_heap: List[tuple] = []
+_admin_token_lock = threading.Lock()
 
 def generate_token():
-    return secrets.token_hex(32)
+    return secrets.token_urlsafe(32)
+
+def _secure_equals(given: str, expected: str) -> bool:
+    """Constant-time string comparison for tokens and credentials"""
+    return hmac.compare_digest(given.encode(), expected.encode())
+
+def _prune_admin_tokens():
+    """Drop expired admin tokens so the store doesn't grow without bound"""
+    now = time.time()
+    with _admin_token_lock:
+        while _admin_token_heap and _admin_token_heap[0][0] < now:
+            _, token = heapq.heappop(_admin_token_heap)
+            expiry = admin_tokens.get(token)
+            if expiry is None:
+                continue
+            if expiry < now:
+                del admin_tokens[token]
+            else:
+                heapq.heappush(_admin_token_heap, (expiry, token))
+
+def issue_admin_token() -> str:
+    _prune_admin_tokens()
+    token = generate_token()
+    expiry = time.time() + ADMIN_TOKEN_TTL
+    with _admin_token_lock:
+        admin_tokens[token] = expiry
+        heapq.heappush(_admin_token_heap, (expiry, token))
+    return token
 
 def verify_admin_token(creds: HTTPAuthorizationCredentials = Depends(security)):
     if not creds:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    _prune_admin_tokens()
     token = creds.credentials
     if token not in admin_tokens or admin_tokens[token] < time.time():
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     # Extend token validity
-    admin_tokens[token] = time.time() + 3600
+    admin_tokens[token] = time.time() + ADMIN_TOKEN_TTL
     return token
 
 def verify_api_key(creds: HTTPAuthorizationCredentials = Depends(security)):
@@ -177,7 +341,7 @@ def verify_api_key(creds: HTTPAuthorizationCredentials = Depends(security)):
         return  # No key configured
     if not creds:
         raise HTTPException(status_code=401, detail="Missing Authorization header")
-    if creds.credentials != api_key:
+    if not _secure_equals(creds.credentials, api_key):
         raise HTTPException(status_code=401, detail="Invalid API Key")
 
 def verify_plugin_token(creds: HTTPAuthorizationCredentials = Depends(security)):
@@ -188,44 +352,113 @@ def verify_plugin_token(creds: HTTPAuthorizationCredentials = Depends(security))
         raise HTTPException(status_code=401, detail="Plugin token not configured")
     if not creds:
         raise HTTPException(status_code=401, detail="Missing Authorization header")
-    if creds.credentials != plugin_token:
+    if not _secure_equals(creds.credentials, plugin_token):
         raise HTTPException(status_code=401, detail="Invalid plugin token")
 
 # =============================================================================
 # Cookie Management
 # =============================================================================
 
+# One ";"-delimited "key=value" part; parts without "=" are skipped. Anchored to part
+# boundaries so a malformed part can't resync mid-way. Whitespace is stripped in Python:
+# optional \s* around the groups would overlap with them and backtrack badly on long runs.
+_COOKIE_PAIR_RE = re.compile(r'(?:^|;)([^=;]*)=([^;]*)')
+
+@functools.lru_cache(maxsize=256)
+def _parse_cookie_pairs(cookie_str: str) -> tuple:
+    """Parse cookie header string into (key, value) pairs; cached since plugins re-push identical strings"""
+    return tuple((k.strip(), v.strip()) for k, v in _COOKIE_PAIR_RE.findall(cookie_str))
+
 def parse_cookie_string(cookie_str: str) -> Dict[str, str]:
     """Parse cookie header string into dict"""
-    cookies = {}
-    for part in cookie_str.split(';'):
-        part = part.strip()
-        if '=' in part:
-            key, value = part.split('=', 1)
-            cookies[key.strip()] = value.strip()
-    return cookies
+    return dict(_parse_cookie_pairs(cookie_str))
+
+def make_cookie_id(psid: str) -> str:
+    """Derive the ID for a newly stored cookie from its PSID"""
+    return hashlib.blake2b(psid.encode(), digest_size=8).hexdigest()
+
+def find_cookie_id(psid: str) -> Optional[str]:
+    """Find the stored cookie ID for a PSID (call under _data_lock)"""
+    return _cookie_ids_by_psid.get(psid)
 
 def get_active_cookie() -> Optional[Dict]:
     """Get a random active cookie for API requests"""
-    cookies = get_cookies()
-    active = [c for c in cookies.values() if c.get("status") == "正常"]
+    active = _active_cookie_ids
     if not active:
         return None
-    return random.choice(active)
+    return get_cookies().get(random.choice(active))
+
+# (cookie_id, with_full_cookies) -> (fingerprint, created_time, client). A pooled client
+# fetches its access token on first use (GeminiClient serializes concurrent first uses), so
+# requests on the same cookie share it instead of re-running init() each time.
+_client_pool: Dict[tuple, tuple] = {}
+_client_pool_lock = threading.Lock()
+
+def get_pooled_client(cookie_id: str, cookie_data: Dict, proxy: Optional[str], with_full_cookies: bool) -> GeminiClient:
+    """Get a cached client for a cookie, rebuilding it if expired or the cookie/proxy changed"""
+    key = (cookie_id, with_full_cookies)
+    fingerprint = (cookie_data["psid"], cookie_data.get("psidts", ""), proxy)
+    with _client_pool_lock:
+        entry = _client_pool.get(key)
+    if entry and entry[0] == fingerprint and time.time() - entry[1] < CLIENT_POOL_TTL:
+        return entry[2]
+    
+    # Build full cookies dict from parsed cookies (contains all original cookies like NID, SID, etc.)
+    full_cookies = {}
+    if cookie_data.get("parsed"):
+        full_cookies.update(cookie_data["parsed"])
+    
+    client = GeminiClient(
+        cookie_data["psid"], 
+        cookie_data.get("psidts", ""),
+        proxy=proxy,
+        full_cookies=full_cookies if with_full_cookies else None  # Only pass full cookies for image operations
+    )
+    with _client_pool_lock:
+        # Also evict clients of cookies deleted since they were pooled
+        cookies = get_cookies()
+        for k in [k for k in _client_pool if k[0] not in cookies]:
+            del _client_pool[k]
+        if cookie_id in cookies:
+            _client_pool[key] = (fingerprint, time.time(), client)
+    return client
+
+def discard_pooled_client(cookie_id: str):
+    """Drop cached clients for a cookie so the next request re-initializes"""
+    with _client_pool_lock:
+        for key in [k for k in _client_pool if k[0] == cookie_id]:
+            del _client_pool[key]
 
 def increment_cookie_usage(cookie_id: str):
-    """Increment usage count for a cookie"""
-    data = load_data()
-    if cookie_id in data["cookies"]:
-        data["cookies"][cookie_id]["use_count"] = data["cookies"][cookie_id].get("use_count", 0) + 1
+    """Increment usage count for a cookie (buffered until the next merge_pending_usage)"""
+    with _data_lock:
+        cookie = get_cookies().get(cookie_id)
+        if cookie is None:
+            return
+        if cookie.get("use_count", 0) == 0 and cookie_id not in _pending_usage:
+            _cookie_stats["unused"] -= 1
+        _pending_usage[cookie_id] += 1
+
+def merge_pending_usage():
+    """Fold buffered use counts into the data and schedule a save"""
+    with _data_lock:
+        if not _pending_usage:
+            return
+        data = load_data()
+        for cookie_id, count in _pending_usage.items():
+            if cookie_id in data["cookies"]:
+                data["cookies"][cookie_id]["use_count"] = data["cookies"][cookie_id].get("use_count", 0) + count
+        _pending_usage.clear()
         save_data(data)
 
 def mark_cookie_failed(cookie_id: str):
     """Mark a cookie as failed"""
-    data = load_data()
-    if cookie_id in data["cookies"]:
-        data["cookies"][cookie_id]["status"] = "失效"
-        save_data(data)
+    with _data_lock:
+        data = load_data()
+        if cookie_id in data["cookies"]:
+            data["cookies"][cookie_id]["status"] = "失效"
+            save_data(data)
+            _index_active_cookies()
 
 # =============================================================================
 # Page Routes
@@ -254,21 +487,24 @@ def api_login(req: LoginRequest):
     expected_user = settings.get("admin_username", "admin")
     expected_pass = settings.get("admin_password", "admin")
     
-    if req.username == expected_user and req.password == expected_pass:
-        token = generate_token()
-        admin_tokens[token] = time.time() + 3600  # 1 hour
+    # Compare both fields in constant time, without short-circuiting on the username
+    user_ok = _secure_equals(req.username, expected_user)
+    pass_ok = _secure_equals(req.password, expected_pass)
+    if user_ok and pass_ok:
+        token = issue_admin_token()
         return {"success": True, "token": token}
     return {"success": False, "message": "用户名或密码错误"}
 
 @app.get("/api/cookies")
 def api_list_cookies(_: str = Depends(verify_admin_token)):
-    cookies = get_cookies()
+    # Copy the items first: other requests add/remove cookies in the shared dict concurrently
+    cookies = list(get_cookies().items())
     data = []
-    for cookie_id, cookie_data in cookies.items():
+    for cookie_id, cookie_data in cookies:
         data.append({
             "cookie_id": cookie_id,
             "status": cookie_data.get("status", "正常"),
-            "use_count": cookie_data.get("use_count", 0),
+            "use_count": cookie_data.get("use_count", 0) + _pending_usage.get(cookie_id, 0),
             "note": cookie_data.get("note", ""),
             "created_time": cookie_data.get("created_time", 0)
         })
@@ -283,50 +519,60 @@ def api_add_cookie(req: AddCookieRequest, _: str = Depends(verify_admin_token)):
     if not psid:
         return {"success": False, "message": "Cookie 中缺少 __Secure-1PSID"}
     
-    # Generate ID from PSID hash
-    cookie_id = hashlib.md5(psid.encode()).hexdigest()[:16]
-    
-    data = load_data()
-    data["cookies"][cookie_id] = {
-        "psid": psid,
-        "psidts": psidts,
-        "parsed": parsed,
-        "status": "正常",
-        "use_count": 0,
-        "note": req.note,
-        "created_time": int(time.time())
-    }
-    save_data(data)
+    with _data_lock:
+        data = load_data()
+        # Replace an existing entry for this PSID (possibly under a legacy ID), else derive a new ID
+        cookie_id = find_cookie_id(psid) or make_cookie_id(psid)
+        _pending_usage.pop(cookie_id, None)  # use_count restarts from 0
+        data["cookies"][cookie_id] = {
+            "psid": psid,
+            "psidts": psidts,
+            "parsed": parsed,
+            "status": "正常",
+            "use_count": 0,
+            "note": req.note,
+            "created_time": int(time.time())
+        }
+        save_data(data)
+        _index_active_cookies()
+        discard_pooled_client(cookie_id)
     
     return {"success": True, "message": "Cookie 添加成功", "cookie_id": cookie_id}
 
 @app.delete("/api/cookies/{cookie_id}")
 def api_delete_cookie(cookie_id: str, _: str = Depends(verify_admin_token)):
-    data = load_data()
-    if cookie_id in data["cookies"]:
-        del data["cookies"][cookie_id]
-        save_data(data)
-        return {"success": True, "message": "删除成功"}
+    with _data_lock:
+        data = load_data()
+        if cookie_id in data["cookies"]:
+            del data["cookies"][cookie_id]
+            _pending_usage.pop(cookie_id, None)
+            save_data(data)
+            _index_active_cookies()
+            discard_pooled_client(cookie_id)
+            return {"success": True, "message": "删除成功"}
     return {"success": False, "message": "Cookie 不存在"}
 
 @app.get("/api/stats")
 def api_stats(_: str = Depends(verify_admin_token)):
-    cookies = get_cookies()
-    total = len(cookies)
-    active = sum(1 for c in cookies.values() if c.get("status") == "正常")
-    failed = sum(1 for c in cookies.values() if c.get("status") == "失效")
-    unused = sum(1 for c in cookies.values() if c.get("use_count", 0) == 0)
-    return {"success": True, "total": total, "active": active, "failed": failed, "unused": unused}
+    return {"success": True, **_cookie_stats}
+
+CACHE_SIZE_TTL = 5  # seconds between full rescans of IMAGES_DIR
+
+# Last scanned size, kept current between scans by save_image_locally / api_clear_cache
+_cache_size = {"t": 0.0, "bytes": 0}
 
 def get_cache_size() -> str:
     """Calculate current image cache size"""
-    total = 0
-    if os.path.exists(IMAGES_DIR):
-        for f in os.listdir(IMAGES_DIR):
-            fp = os.path.join(IMAGES_DIR, f)
-            if os.path.isfile(fp):
-                total += os.path.getsize(fp)
-    mb = total / (1024 * 1024)
+    now = time.time()
+    if now - _cache_size["t"] >= CACHE_SIZE_TTL:
+        total = 0
+        if os.path.exists(IMAGES_DIR):
+            # scandir serves is_file()/stat() from the directory listing where it can
+            with os.scandir(IMAGES_DIR) as it:
+                total = sum(e.stat(follow_symlinks=False).st_size for e in it if e.is_file(follow_symlinks=False))
+        _cache_size["bytes"] = total
+        _cache_size["t"] = now
+    mb = _cache_size["bytes"] / (1024 * 1024)
     return f"{mb:.1f} MB"
 
 @app.get("/api/settings")
@@ -347,34 +593,35 @@ def api_get_settings(_: str = Depends(verify_admin_token)):
 
 @app.post("/api/settings")
 def api_save_settings(req: SettingsUpdate, _: str = Depends(verify_admin_token)):
-    data = load_data()
-    if "settings" not in data:
-        data["settings"] = {}
-    
-    if req.admin_username:
-        data["settings"]["admin_username"] = req.admin_username
-    if req.admin_password:  # Only update if provided
-        data["settings"]["admin_password"] = req.admin_password
-    data["settings"]["api_key"] = req.api_key
-    data["settings"]["image_mode"] = req.image_mode
-    data["settings"]["base_url"] = req.base_url
-    data["settings"]["image_cache_max_size"] = req.image_cache_max_size
-    data["settings"]["proxy_url"] = req.proxy_url
-    data["settings"]["timeout"] = req.timeout
-    
-    save_data(data)
+    with _data_lock:
+        data = load_data()
+        if "settings" not in data:
+            data["settings"] = {}
+        
+        if req.admin_username:
+            data["settings"]["admin_username"] = req.admin_username
+        if req.admin_password:  # Only update if provided
+            data["settings"]["admin_password"] = req.admin_password
+        data["settings"]["api_key"] = req.api_key
+        data["settings"]["image_mode"] = req.image_mode
+        data["settings"]["base_url"] = req.base_url
+        data["settings"]["image_cache_max_size"] = req.image_cache_max_size
+        data["settings"]["proxy_url"] = req.proxy_url
+        data["settings"]["timeout"] = req.timeout
+        
+        save_data(data)
     return {"success": True, "message": "设置已保存"}
 
 @app.post("/api/settings/plugin-token/regenerate")
 def api_regenerate_plugin_token(_: str = Depends(verify_admin_token)):
     """Regenerate plugin connection token"""
-    data = load_data()
-    if "settings" not in data:
-        data["settings"] = {}
-    
-    new_token = secrets.token_urlsafe(32)
-    data["settings"]["plugin_token"] = new_token
-    save_data(data)
+    new_token = generate_token()
+    with _data_lock:
+        data = load_data()
+        if "settings" not in data:
+            data["settings"] = {}
+        data["settings"]["plugin_token"] = new_token
+        save_data(data)
     
     return {"success": True, "token": new_token, "message": "插件 Token 已重新生成"}
 
@@ -383,11 +630,13 @@ def api_clear_cache(_: str = Depends(verify_admin_token)):
     """Clear image cache"""
     count = 0
     if os.path.exists(IMAGES_DIR):
-        for f in os.listdir(IMAGES_DIR):
-            fp = os.path.join(IMAGES_DIR, f)
-            if os.path.isfile(fp):
-                os.remove(fp)
-                count += 1
+        with os.scandir(IMAGES_DIR) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    os.remove(entry.path)
+                    count += 1
+    _cache_size["bytes"] = 0
+    _cache_size["t"] = time.time()
     return {"success": True, "message": f"已清除 {count} 个缓存文件"}
 
 # =============================================================================
@@ -408,56 +657,45 @@ def api_plugin_update_cookie(req: PluginCookieUpdate, _: str = Depends(verify_pl
     if not req.cookie_str and not req.psid:
         raise HTTPException(status_code=400, detail="Missing cookie data")
     
-    # Parse cookie string
-    parsed = {}
-    psid = req.psid or ""
-    psidts = req.psidts or ""
-    
-    if req.cookie_str:
-        for part in req.cookie_str.split(';'):
-            part = part.strip()
-            if '=' in part:
-                key, val = part.split('=', 1)
-                parsed[key.strip()] = val.strip()
-                if key.strip() == "__Secure-1PSID":
-                    psid = val.strip()
-                if key.strip() == "__Secure-1PSIDTS":
-                    psidts = val.strip()
+    # Parse cookie string (values in it take precedence over the explicit fields)
+    parsed = parse_cookie_string(req.cookie_str) if req.cookie_str else {}
+    psid = parsed.get("__Secure-1PSID", req.psid or "")
+    psidts = parsed.get("__Secure-1PSIDTS", req.psidts or "")
     
     if not psid:
         raise HTTPException(status_code=400, detail="Cookie中未找到 __Secure-1PSID")
     
-    data = load_data()
-    
-    # Check if this PSID already exists
-    existing_id = None
-    for cid, cdata in data["cookies"].items():
-        if cdata.get("psid") == psid:
-            existing_id = cid
-            break
-    
-    if existing_id:
-        # Update existing cookie
-        data["cookies"][existing_id]["psidts"] = psidts
-        data["cookies"][existing_id]["parsed"] = parsed
-        data["cookies"][existing_id]["status"] = "正常"
-        data["cookies"][existing_id]["note"] = f"插件更新 {time.strftime('%Y-%m-%d %H:%M')}"
-        save_data(data)
-        return {"success": True, "message": "Cookie 已更新", "action": "updated", "cookie_id": existing_id}
-    else:
-        # Add new cookie
-        cookie_id = hashlib.md5(psid.encode()).hexdigest()[:16]
-        data["cookies"][cookie_id] = {
-            "psid": psid,
-            "psidts": psidts,
-            "parsed": parsed,
-            "status": "正常",
-            "note": f"插件添加 {time.strftime('%Y-%m-%d %H:%M')}",
-            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "use_count": 0
-        }
-        save_data(data)
-        return {"success": True, "message": "Cookie 已添加", "action": "added", "cookie_id": cookie_id}
+    with _data_lock:
+        data = load_data()
+        
+        # Check if this PSID already exists
+        existing_id = find_cookie_id(psid)
+        
+        if existing_id:
+            # Update existing cookie
+            data["cookies"][existing_id]["psidts"] = psidts
+            data["cookies"][existing_id]["parsed"] = parsed
+            data["cookies"][existing_id]["status"] = "正常"
+            data["cookies"][existing_id]["note"] = f"插件更新 {time.strftime('%Y-%m-%d %H:%M')}"
+            save_data(data)
+            _index_active_cookies()
+            discard_pooled_client(existing_id)
+            return {"success": True, "message": "Cookie 已更新", "action": "updated", "cookie_id": existing_id}
+        else:
+            # Add new cookie
+            cookie_id = make_cookie_id(psid)
+            data["cookies"][cookie_id] = {
+                "psid": psid,
+                "psidts": psidts,
+                "parsed": parsed,
+                "status": "正常",
+                "note": f"插件添加 {time.strftime('%Y-%m-%d %H:%M')}",
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "use_count": 0
+            }
+            save_data(data)
+            _index_active_cookies()
+            return {"success": True, "message": "Cookie 已添加", "action": "added", "cookie_id": cookie_id}
 
 # =============================================================================
 # Legacy Endpoints (for backward compatibility)
@@ -500,27 +738,127 @@ class ChatCompletionResponse(BaseModel):
     choices: List[ChatCompletionResponseChoice]
     usage: Dict[str, int]
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Pooled session for image downloads. Cookies are passed per call and never stored,
+# since downloads for different accounts share it.
+_download_session = requests.Session()
+_download_session.cookies.set_policy(DiscardCookiesPolicy())
+_download_session.headers.update({"User-Agent": Headers.Gemini["User-Agent"]})
+_download_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+_download_session.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
 def save_image_locally(url: str, cookies: Dict[str, str]) -> Optional[str]:
     """Downloads image and returns local filename"""
+    path = None
     try:
         if "=s" not in url:
             url += "=s2048"
-        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"}
-        resp = requests.get(url, cookies=cookies, headers=headers, timeout=30)
-        if resp.status_code == 200:
-            filename = f"img_{uuid.uuid4().hex}.png"
-            path = os.path.join(IMAGES_DIR, filename)
-            with open(path, "wb") as f:
-                f.write(resp.content)
-            return filename
+        with _download_session.get(url, cookies=cookies, timeout=30, stream=True) as resp:
+            if resp.status_code == 200:
+                filename = f"img_{uuid.uuid4().hex}.png"
+                path = os.path.join(IMAGES_DIR, filename)
+                size = 0
+                with open(path, "wb") as f:
+                    for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+                _cache_size["bytes"] += size
+                return filename
     except Exception as e:
         print(f"Image download failed: {e}")
+        # Don't leave a truncated file in the cache
+        if path:
+            remove_temp_files([path])
     return None
 
 def image_to_base64(path: str) -> str:
     with open(path, "rb") as f:
         return base64.b64encode(f.read()).decode('utf-8')
 
+def remove_temp_files(paths: List[str]):
+    """Best-effort removal of temporary upload files"""
+    for f in paths:
+        try:
+            if os.path.exists(f):
+                os.remove(f)
+        except:
+            pass
+
+MAX_PARALLEL_IMAGE_LOADS = 8
+
+# Small decoded uploads only live until they're sent to Gemini; keep them on tmpfs when
+# available. The size cap keeps concurrent requests from filling Docker's small /dev/shm.
+TMPFS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+TMPFS_MAX_UPLOAD_SIZE = 2 * 1024 * 1024
+
+# Keywords (in lowercased error messages) that suggest an auth/cookie problem worth retrying with another cookie
+_RETRYABLE_ERROR_RE = re.compile(r"503|401|unauthorized|auth|cookie|token|psid|expired")
+
+# Failures a fresh access token may fix. 429/5xx are left out: the client has already retried
+# those with backoff, and re-initializing would only add more load upstream.
+_STALE_CLIENT_ERROR_RE = re.compile(r"unauthorized|forbidden|auth|cookie|token|psid|expired")
+
+def is_stale_client_error(e: Exception) -> bool:
+    """Whether a pooled client's failure looks like a stale token/session rather than upstream load"""
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        # An expired "at" token is rejected with a plain 400
+        return e.response.status_code in (400, 401, 403)
+    return bool(_STALE_CLIENT_ERROR_RE.search(str(e).lower()))
+
+def _load_image_part(url: str) -> Optional[str]:
+    """Save one OpenAI-style image_url (data: URI or http URL) to a temp file, returning its path"""
+    if url.startswith("data:"):
+        # Base64 encoded image
+        try:
+            # data:image/jpeg;base64,/9j/4AAQSkZJRg...
+            header, b64_data = url.split(",", 1)
+            img_data = base64.b64decode(b64_data)
+            
+            # Determine extension
+            ext = "png"
+            if "jpeg" in header or "jpg" in header:
+                ext = "jpg"
+            elif "webp" in header:
+                ext = "webp"
+            
+            # Save to temp file
+            if TMPFS_DIR and len(img_data) <= TMPFS_MAX_UPLOAD_SIZE:
+                temp_path = os.path.join(TMPFS_DIR, f"upload_{uuid.uuid4().hex}.{ext}")
+                try:
+                    with open(temp_path, "wb") as f:
+                        f.write(img_data)
+                    return temp_path
+                except OSError as e:
+                    # tmpfs full (e.g. ENOSPC on a small /dev/shm); fall back to disk
+                    print(f"Writing upload to {TMPFS_DIR} failed, using disk: {e}")
+                    remove_temp_files([temp_path])
+            temp_path = os.path.join(IMAGES_DIR, f"upload_{uuid.uuid4().hex}.{ext}")
+            with open(temp_path, "wb") as f:
+                f.write(img_data)
+            return temp_path
+        except Exception as e:
+            print(f"Failed to decode base64 image: {e}")
+    elif url.startswith("http"):
+        # URL - download it
+        temp_path = None
+        try:
+            with _download_session.get(url, timeout=30, stream=True) as resp:
+                if resp.status_code == 200:
+                    ext = "png"
+                    if "jpeg" in url or "jpg" in url:
+                        ext = "jpg"
+                    temp_path = os.path.join(IMAGES_DIR, f"upload_{uuid.uuid4().hex}.{ext}")
+                    with open(temp_path, "wb") as f:
+                        for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                    return temp_path
+        except Exception as e:
+            print(f"Failed to download image from URL: {e}")
+            if temp_path:
+                remove_temp_files([temp_path])
+    return None
+
 def extract_content_and_images(content: Union[str, List[Dict[str, Any]]]) -> tuple:
     """Extract text and image files from OpenAI-style multimodal content.
     Returns (text_prompt, list_of_temp_image_paths)
@@ -529,53 +867,44 @@ def extract_content_and_images(content: Union[str, List[Dict[str, Any]]]) -> tup
         return content, []
     
     text_parts = []
-    image_paths = []
+    image_urls = []
     
     for part in content:
         if part.get("type") == "text":
             text_parts.append(part.get("text", ""))
         elif part.get("type") == "image_url":
             image_url_obj = part.get("image_url", {})
-            url = image_url_obj.get("url", "")
-            
-            if url.startswith("data:"):
-                # Base64 encoded image
-                try:
-                    # data:image/jpeg;base64,/9j/4AAQSkZJRg...
-                    header, b64_data = url.split(",", 1)
-                    img_data = base64.b64decode(b64_data)
-                    
-                    # Determine extension
-                    ext = "png"
-                    if "jpeg" in header or "jpg" in header:
-                        ext = "jpg"
-                    elif "webp" in header:
-                        ext = "webp"
-                    
-                    # Save to temp file
-                    temp_path = os.path.join(IMAGES_DIR, f"upload_{uuid.uuid4().hex}.{ext}")
-                    with open(temp_path, "wb") as f:
-                        f.write(img_data)
-                    image_paths.append(temp_path)
-                except Exception as e:
-                    print(f"Failed to decode base64 image: {e}")
-            elif url.startswith("http"):
-                # URL - download it
-                try:
-                    resp = requests.get(url, timeout=30)
-                    if resp.status_code == 200:
-                        ext = "png"
-                        if "jpeg" in url or "jpg" in url:
-                            ext = "jpg"
-                        temp_path = os.path.join(IMAGES_DIR, f"upload_{uuid.uuid4().hex}.{ext}")
-                        with open(temp_path, "wb") as f:
-                            f.write(resp.content)
-                        image_paths.append(temp_path)
-                except Exception as e:
-                    print(f"Failed to download image from URL: {e}")
+            image_urls.append(image_url_obj.get("url", ""))
+    
+    # Load images concurrently; map() keeps them in message order
+    if len(image_urls) > 1:
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_IMAGE_LOADS, len(image_urls))) as executor:
+            loaded = list(executor.map(_load_image_part, image_urls))
+    else:
+        loaded = [_load_image_part(u) for u in image_urls]
+    image_paths = [p for p in loaded if p]
     
     return " ".join(text_parts), image_paths
 
+# Blocking upstream work (Gemini calls, image downloads/uploads, cookie rotation) runs on its
+# own pool. asyncio's default executor has only min(32, cpu_count + 4) threads, which would cap
+# in-flight generations below MAX_CONCURRENT_GENERATES and queue data flushes and temp-file
+# cleanup (which stay on the default executor) behind calls that can take minutes.
+UPSTREAM_WORKERS = MAX_CONCURRENT_GENERATES + MAX_CONCURRENT_UPLOADS
+_upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream")
+
+async def run_upstream(func, *args):
+    """Run a blocking upstream call on the upstream pool so the event loop stays free"""
+    return await asyncio.get_running_loop().run_in_executor(_upstream_executor, functools.partial(func, *args))
+
+async def run_client(client: GeminiClient, prompt: str, image_files: List[str], model: str):
+    """Generate a reply; the client initializes itself on first use"""
+    # Use generate_content for multimodal, otherwise simple chat
+    if image_files:
+        return await run_upstream(client.generate_content, prompt, image_files, model, None, None)
+    chat = client.start_chat(model=model)
+    return await run_upstream(chat.send_message, prompt)
+
 @app.post("/v1/chat/completions", dependencies=[Depends(verify_api_key)])
 async def chat_completions(req: ChatCompletionRequest, request: Request):
     if not req.messages:
@@ -583,8 +912,8 @@ async def chat_completions(req: ChatCompletionRequest, request: Request):
     
     last_msg = req.messages[-1]
     
-    # Extract text and images from multimodal content
-    prompt, image_files = extract_content_and_images(last_msg.content)
+    # Extract text and images from multimodal content (downloads/decodes block, so off-loop)
+    prompt, image_files = await run_upstream(extract_content_and_images, last_msg.content)
     temp_files = image_files  # Track for cleanup
     
     # Get settings for proxy
@@ -597,160 +926,128 @@ async def chat_completions(req: ChatCompletionRequest, request: Request):
     last_error = None
     tried_cookie_ids = set()
     
-    for attempt in range(max_retries):
-        # Get an active cookie (exclude already tried ones)
-        cookies_dict = get_cookies()
-        active_cookies = [
-            (cid, cdata) for cid, cdata in cookies_dict.items()
-            if cdata.get("status") == "正常" and cid not in tried_cookie_ids
-        ]
+    # Snapshot the active cookies once; attempts only need to skip the ones already tried
+    cookies_dict = get_cookies()
+    active_cookies = [(cid, cookies_dict[cid]) for cid in _active_cookie_ids if cid in cookies_dict]
+    
+    # Temp uploads are removed however the request ends (success, error, or no usable cookie)
+    try:
+        for attempt in range(max_retries):
+            # Get an active cookie (exclude already tried ones)
+            candidates = [c for c in active_cookies if c[0] not in tried_cookie_ids]
         
-        if not active_cookies:
-            # No more cookies to try
-            break
+            if not candidates:
+                # No more cookies to try
+                break
         
-        # Pick a random active cookie
-        cookie_id, cookie_data = random.choice(active_cookies)
-        tried_cookie_ids.add(cookie_id)
+            # Pick a random active cookie
+            cookie_id, cookie_data = random.choice(candidates)
+            tried_cookie_ids.add(cookie_id)
         
-        try:
-            # Build full cookies dict from parsed cookies (contains all original cookies like NID, SID, etc.)
-            full_cookies = {}
-            if cookie_data.get("parsed"):
-                full_cookies.update(cookie_data["parsed"])
-            
-            # Create client with full cookie set for image operations
-            client = GeminiClient(
-                cookie_data["psid"], 
-                cookie_data.get("psidts", ""),
-                proxy=proxy,
-                full_cookies=full_cookies if image_files else None  # Only pass full cookies for image operations
-            )
-            client.init()
-            
-            # Use generate_content for multimodal, otherwise simple chat
-            if image_files:
-                output = client.generate_content(prompt, image_files, req.model, None, None)
-            else:
-                chat = client.start_chat(model=req.model)
-                output = chat.send_message(prompt)
+            try:
+                # Reuse the pooled client (full cookie set for image operations)
+                client = get_pooled_client(cookie_id, cookie_data, proxy, bool(image_files))
+                reused = client.running
+                try:
+                    output = await run_client(client, prompt, image_files, req.model)
+                except Exception as e:
+                    if not reused or not is_stale_client_error(e):
+                        raise
+                    # The pooled client's token/session may be stale; re-initialize once on the
+                    # same cookie before the error counts against the cookie
+                    print(f"Pooled client for cookie {cookie_id[:8]}... failed, re-initializing: {e}")
+                    discard_pooled_client(cookie_id)
+                    client = get_pooled_client(cookie_id, cookie_data, proxy, bool(image_files))
+                    output = await run_client(client, prompt, image_files, req.model)
             
-            # Increment usage on success
-            increment_cookie_usage(cookie_id)
+                # Increment usage on success
+                increment_cookie_usage(cookie_id)
             
-            content = output.text
+                content = output.text
             
-            if output.candidates:
-                candidate = output.candidates[output.chosen]
-                for img in candidate.generated_images:
-                    local_name = save_image_locally(img.image.url, client.cookies)
+                if output.candidates:
+                    candidate = output.candidates[output.chosen]
+                    for img in candidate.generated_images:
+                        local_name = await run_upstream(save_image_locally, img.image.url, client.cookies)
                     
-                    final_url = img.image.url
+                        final_url = img.image.url
                     
-                    if local_name:
-                        local_path = os.path.join(IMAGES_DIR, local_name)
+                        if local_name:
+                            local_path = os.path.join(IMAGES_DIR, local_name)
                         
-                        if image_mode == "base64":
-                            try:
-                                b64_str = image_to_base64(local_path)
-                                final_url = f"data:image/png;base64,{b64_str}"
-                            except:
-                                pass
-                        else:
-                            final_url = f"{request.base_url}static/images/{local_name}"
+                            if image_mode == "base64":
+                                try:
+                                    b64_str = await run_upstream(image_to_base64, local_path)
+                                    final_url = f"data:image/png;base64,{b64_str}"
+                                except:
+                                    pass
+                            else:
+                                final_url = f"{request.base_url}static/images/{local_name}"
                     
-                    content += f"\n\n![Generated Image]({final_url})"
+                        content += f"\n\n![Generated Image]({final_url})"
             
-            # Handle Streaming Request
-            if req.stream:
-                from fastapi.responses import StreamingResponse
+                # Handle Streaming Request
+                if req.stream:
+                    from fastapi.responses import StreamingResponse
                 
-                async def generate_stream():
-                    chunk_id = f"chatcmpl-{uuid.uuid4()}"
-                    created = int(time.time())
+                    async def generate_stream():
+                        chunk_id = f"chatcmpl-{uuid.uuid4()}"
+                        created = int(time.time())
                     
-                    # Yield single chunk with full content (simulated stream)
-                    # Clients usually expect small chunks, but one big chunk is valid SSE
-                    chunk_data = {
-                        "id": chunk_id,
-                        "object": "chat.completion.chunk",
-                        "created": created,
-                        "model": req.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {"role": "assistant", "content": content},
-                                "finish_reason": None
-                            }
-                        ]
-                    }
-                    yield f"data: {json.dumps(chunk_data)}\n\n"
+                        # Every chunk shares the same envelope up to the delta; serialize it once
+                        prefix = (
+                            f'data: {{"id":"{chunk_id}","object":"chat.completion.chunk","created":{created},'
+                            f'"model":{orjson.dumps(req.model).decode()},"choices":[{{"index":0,"delta":'
+                        )
                     
-                    # Stop chunk
-                    stop_data = {
-                        "id": chunk_id,
-                        "object": "chat.completion.chunk",
-                        "created": created,
-                        "model": req.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": "stop"
-                            }
-                        ]
-                    }
-                    yield f"data: {json.dumps(stop_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                        # Yield single chunk with full content (simulated stream)
+                        # Clients usually expect small chunks, but one big chunk is valid SSE
+                        yield prefix + '{"role":"assistant","content":' + orjson.dumps(content).decode() + '},"finish_reason":null}]}\n\n'
                     
-                return StreamingResponse(generate_stream(), media_type="text/event-stream")
-
-            return ChatCompletionResponse(
-                id=f"chatcmpl-{uuid.uuid4()}",
-                created=int(time.time()),
-                model=req.model,
-                choices=[
-                    ChatCompletionResponseChoice(
-                        index=0,
-                        message={"role": "assistant", "content": content},
-                        finish_reason="stop"
-                    )
-                ],
-                usage={"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-            )
+                        # Stop chunk
+                        yield prefix + '{},"finish_reason":"stop"}]}\n\n'
+                        yield "data: [DONE]\n\n"
+                    
+                    return StreamingResponse(generate_stream(), media_type="text/event-stream")
+
+                return ChatCompletionResponse(
+                    id=f"chatcmpl-{uuid.uuid4()}",
+                    created=int(time.time()),
+                    model=req.model,
+                    choices=[
+                        ChatCompletionResponseChoice(
+                            index=0,
+                            message={"role": "assistant", "content": content},
+                            finish_reason="stop"
+                        )
+                    ],
+                    usage={"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+                )
             
-        except Exception as e:
-            last_error = e
-            error_msg = str(e).lower()
+            except Exception as e:
+                last_error = e
+                error_msg = str(e).lower()
+                # Token or cookies may be stale; rebuild the client next time
+                discard_pooled_client(cookie_id)
             
-            # Check if this is a retryable error (auth/cookie related)
-            is_retryable = any(keyword in error_msg for keyword in [
-                "503", "401", "unauthorized", "auth", "cookie", "token", "psid", "expired"
-            ])
+                # Check if this is a retryable error (auth/cookie related)
+                is_retryable = bool(_RETRYABLE_ERROR_RE.search(error_msg))
             
-            if is_retryable:
-                print(f"Attempt {attempt + 1}/{max_retries} failed with cookie {cookie_id[:8]}...: {e}")
-                # Mark cookie as potentially problematic (don't mark as failed yet, just increment failure count)
-                if attempt == max_retries - 1:
-                    # Only mark as failed on last retry
+                if is_retryable:
+                    print(f"Attempt {attempt + 1}/{max_retries} failed with cookie {cookie_id[:8]}...: {e}")
+                    # Mark cookie as potentially problematic (don't mark as failed yet, just increment failure count)
+                    if attempt == max_retries - 1:
+                        # Only mark as failed on last retry
+                        mark_cookie_failed(cookie_id)
+                else:
+                    # Non-retryable error, mark cookie as failed and raise immediately
                     mark_cookie_failed(cookie_id)
-            else:
-                # Non-retryable error, mark cookie as failed and raise immediately
-                mark_cookie_failed(cookie_id)
-                raise HTTPException(status_code=500, detail=str(e))
-        
-        finally:
-            # Cleanup temp uploaded files only on last attempt or success
-            if attempt == max_retries - 1 or 'output' in locals():
-                for f in temp_files:
-                    try:
-                        if os.path.exists(f):
-                            os.remove(f)
-                    except:
-                        pass
+                    raise HTTPException(status_code=500, detail=str(e))
     
-    # All retries exhausted
-    raise HTTPException(status_code=503, detail=f"All cookies failed. Last error: {last_error}")
+        # All retries exhausted
+        raise HTTPException(status_code=503, detail=f"All cookies failed. Last error: {last_error}")
+    finally:
+        await asyncio.to_thread(remove_temp_files, temp_files)
 
 @app.get("/v1/models")
 def list_models():
@@ -767,70 +1064,114 @@ def list_models():
 # Background Tasks
 # =============================================================================
 
+REFRESH_LOCK_FILE = os.path.join(DATA_DIR, "cookies.json.refresh.lock")
+_refresh_lock_file = None  # kept open (and locked) for the life of the process once acquired
+
+def acquire_refresh_leadership() -> bool:
+    """With several workers on one DATA_DIR, only the process holding this lock rotates cookies"""
+    global _refresh_lock_file
+    if _refresh_lock_file is not None or fcntl is None:
+        return True
+    f = open(REFRESH_LOCK_FILE, "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _refresh_lock_file = f
+    return True
+
 async def cookie_refresh_loop():
     """Periodically refresh cookies using full cookie set"""
     from .auth import rotate_1psidts
     
-    while True:
-        await asyncio.sleep(COOKIE_REFRESH_INTERVAL)
-        print("Starting cookie refresh cycle...")
+    async def refresh_one(sem: asyncio.Semaphore, cookie_id: str, cookie_data: Dict, proxy: Optional[str]) -> Optional[str]:
+        # Build FULL cookies dict from parsed cookies (contains all original cookies)
+        full_cookies = {}
+        if cookie_data.get("parsed"):
+            full_cookies.update(cookie_data["parsed"])
         
-        data = load_data()
-        cookies = data.get("cookies", {})
-        updated = False
+        # Ensure PSID and PSIDTS are present
+        full_cookies["__Secure-1PSID"] = cookie_data["psid"]
+        if cookie_data.get("psidts"):
+            full_cookies["__Secure-1PSIDTS"] = cookie_data["psidts"]
         
-        for cookie_id, cookie_data in cookies.items():
-            if cookie_data.get("status") != "正常":
-                continue
-            
+        async with sem:
+            print(f"Refreshing cookie {cookie_id[:8]}... with {len(full_cookies)} cookies")
             try:
-                # Build FULL cookies dict from parsed cookies (contains all original cookies)
-                full_cookies = {}
-                if cookie_data.get("parsed"):
-                    full_cookies.update(cookie_data["parsed"])
-                
-                # Ensure PSID and PSIDTS are present
-                full_cookies["__Secure-1PSID"] = cookie_data["psid"]
-                if cookie_data.get("psidts"):
-                    full_cookies["__Secure-1PSIDTS"] = cookie_data["psidts"]
-                
-                print(f"Refreshing cookie {cookie_id[:8]}... with {len(full_cookies)} cookies")
-                
-                # Get proxy from settings
-                settings = get_settings()
-                proxy = settings.get("proxy_url", "")
-                
-                # Call rotate directly with full cookies
-                new_psidts = rotate_1psidts(full_cookies, proxy if proxy else None)
-                
-                if new_psidts:
-                    if new_psidts != cookie_data.get("psidts"):
-                        # Update in data
-                        data["cookies"][cookie_id]["psidts"] = new_psidts
-                        if "parsed" in data["cookies"][cookie_id]:
-                            data["cookies"][cookie_id]["parsed"]["__Secure-1PSIDTS"] = new_psidts
-                        updated = True
-                        print(f"Cookie {cookie_id[:8]}... refreshed with new PSIDTS")
-                    else:
-                        print(f"Cookie {cookie_id[:8]}... PSIDTS unchanged")
-                else:
-                    print(f"Cookie {cookie_id[:8]}... refresh returned None (may need re-login)")
-                    
+                # Call rotate directly with full cookies (blocking, so in a worker thread)
+                return await run_upstream(rotate_1psidts, full_cookies, proxy)
             except Exception as e:
                 print(f"Failed to refresh cookie {cookie_id[:8]}...: {e}")
+                return None
+    
+    while True:
+        await asyncio.sleep(COOKIE_REFRESH_INTERVAL)
+        # Other workers pick up the rotated PSIDTS when the leader's write reaches DATA_FILE
+        if not acquire_refresh_leadership():
+            continue
+        print("Starting cookie refresh cycle...")
         
-        # Save if any cookies were updated
-        if updated:
-            save_data(data)
-            print("Cookie data saved to disk")
+        # Snapshot active cookies: the shared data may change while rotations are in flight
+        targets = [(cid, cdata) for cid, cdata in list(get_cookies().items()) if cdata.get("status") == "正常"]
+        proxy = get_settings().get("proxy_url", "") or None
+        
+        # Rotate concurrently, at most COOKIE_REFRESH_CONCURRENCY at a time
+        sem = asyncio.Semaphore(COOKIE_REFRESH_CONCURRENCY)
+        results = await asyncio.gather(*(refresh_one(sem, cid, cdata, proxy) for cid, cdata in targets))
+        
+        updated = False
+        with _data_lock:
+            data = load_data()
+            for (cookie_id, cookie_data), new_psidts in zip(targets, results):
+                if not new_psidts:
+                    print(f"Cookie {cookie_id[:8]}... refresh returned None (may need re-login)")
+                elif new_psidts == cookie_data.get("psidts"):
+                    print(f"Cookie {cookie_id[:8]}... PSIDTS unchanged")
+                elif cookie_id in data["cookies"]:
+                    # Update in data
+                    data["cookies"][cookie_id]["psidts"] = new_psidts
+                    if "parsed" in data["cookies"][cookie_id]:
+                        data["cookies"][cookie_id]["parsed"]["__Secure-1PSIDTS"] = new_psidts
+                    updated = True
+                    print(f"Cookie {cookie_id[:8]}... refreshed with new PSIDTS")
+            
+            # Save if any cookies were updated
+            if updated:
+                save_data(data)
+                print("Cookie data scheduled for saving")
         
         print("Cookie refresh cycle complete")
 
+async def data_flush_loop():
+    """Periodically write pending data changes to disk and pick up external edits"""
+    last_usage_merge = time.time()
+    while True:
+        await asyncio.sleep(DATA_FLUSH_INTERVAL)
+        try:
+            if time.time() - last_usage_merge >= USAGE_FLUSH_INTERVAL:
+                merge_pending_usage()
+                last_usage_merge = time.time()
+            # File I/O blocks; keep it off the event loop
+            await asyncio.to_thread(flush_data)
+            await asyncio.to_thread(reload_data_if_changed)
+        except Exception as e:
+            print(f"Error saving data: {e}")
+
 @app.on_event("startup")
 async def startup():
-    # Ensure data file exists
+    # Load data into memory and ensure data file exists
+    data = load_data()
     if not os.path.exists(DATA_FILE):
-        save_data({"cookies": {}, "settings": {"admin_username": "admin", "admin_password": "admin", "api_key": "sk-123456", "image_mode": "url", "base_url": ""}})
+        save_data(data)
+        flush_data()
     
     print("GeminiWeb2API started. Visit /admin to configure.")
     asyncio.create_task(cookie_refresh_loop())
+    asyncio.create_task(data_flush_loop())
+
+@app.on_event("shutdown")
+async def shutdown():
+    merge_pending_usage()
+    await asyncio.to_thread(flush_data)
+    _upstream_executor.shutdown(wait=False, cancel_futures=True)
@@ -1,17 +1,22 @@
 import argparse
 import uvicorn
-from geminiweb2api.server import app
 
 def main():
     parser = argparse.ArgumentParser(description="GeminiWeb2API - Gemini Web Proxy")
     parser.add_argument("--host", default="0.0.0.0", help="Host to bind")
     parser.add_argument("--port", type=int, default=8000, help="Port to bind")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (state is per process, see README)")
     
     args = parser.parse_args()
     
+    if args.workers > 1:
+        print(f"Warning: running {args.workers} workers. Admin logins and unsaved cookie data are kept per process;")
+        print("only one worker rotates cookies (not enforced on Windows, where every worker rotates them).")
+    
     print(f"Starting server on {args.host}:{args.port}")
     print(f"Visit http://localhost:{args.port}/admin to configure")
-    uvicorn.run(app, host=args.host, port=args.port)
+    # Import string so uvicorn can spawn workers; loop/http "auto" pick uvloop/httptools when installed
+    uvicorn.run("geminiweb2api.server:app", host=args.host, port=args.port, workers=args.workers, loop="auto", http="auto")
 
 if __name__ == "__main__":
     main()